@@ -1,107 +1,1102 @@
+import asyncio
+import atexit
+import collections
+import collections.abc
+import concurrent.futures
+import contextvars
+import fileinput
 import functools
+import importlib
+import importlib.metadata
+import inspect
+import itertools
+import json
+import logging
+import os
+import pathlib
+import random
+import reprlib
+import sys
+import threading
 import time
-import pint
+import types
+import weakref
 
-REGISTERED = {}
 
+class PluginRegistry(collections.abc.Mapping):
+    """Registry of functions that are imported when they're first looked up
 
-def register(func):
+    Plugins are either functions or import targets like "module:function".
+    Names can be put in a namespace, and are then looked up as
+    "namespace.name". When several plugins share a name, the one with the
+    highest priority is used, and the latest one among equal priorities.
+    Adding the same function or target again with the same priority replaces
+    the earlier entry. Aliases are alternative names for a plugin.
+    """
+
+    def __init__(self):
+        self._plugins = {}  # name -> [priority, order, function or target]
+        self._aliases = {}
+        self._order = itertools.count()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _qualified(name, namespace=None):
+        return name if namespace is None else f"{namespace}.{name}"
+
+    @staticmethod
+    def _target(plugin):
+        """Import target of a plugin, in the form module:function"""
+        if isinstance(plugin, str):
+            return plugin
+        return f"{plugin.__module__}:{plugin.__qualname__}"
+
+    def add(self, name, plugin, *, namespace=None, aliases=(), priority=0):
+        key = self._qualified(name, namespace)
+        target = self._target(plugin)
+        with self._lock:
+            # Replace earlier entries of the same plugin, including lazy ones
+            entries = self._plugins.setdefault(key, [])
+            entries[:] = [
+                entry
+                for entry in entries
+                if entry[0] != priority or self._target(entry[2]) != target
+            ]
+            entries.append([priority, next(self._order), plugin])
+            entries.sort(key=lambda entry: (-entry[0], -entry[1]))
+            for alias in aliases:
+                self._aliases[self._qualified(alias, namespace)] = key
+
+    def __getitem__(self, name):
+        entry = self._plugins[self._aliases.get(name, name)][0]
+        if isinstance(entry[2], str):
+            module_name, _, attributes = entry[2].partition(":")
+            plugin = importlib.import_module(module_name)
+            for attribute in attributes.split("."):
+                plugin = getattr(plugin, attribute)
+            entry[2] = plugin
+        return entry[2]
+
+    def __contains__(self, name):
+        return self._aliases.get(name, name) in self._plugins
+
+    def __iter__(self):
+        """Iterate over names, the highest priorities first"""
+        return iter(
+            sorted(
+                self._plugins,
+                key=lambda key: (-self._plugins[key][0][0], self._plugins[key][0][1]),
+            )
+        )
+
+    def __len__(self):
+        return len(self._plugins)
+
+    def names(self, namespace=None):
+        """List the names of plugins in one namespace, without the prefix"""
+        if namespace is None:
+            return [key for key in self if "." not in key]
+        prefix = f"{namespace}."
+        return [key.removeprefix(prefix) for key in self if key.startswith(prefix)]
+
+    def write_manifest(self, path):
+        """Store import targets of all plugins, so they can be loaded lazily"""
+        aliases = collections.defaultdict(list)
+        for alias, key in self._aliases.items():
+            aliases[key].append(alias)
+        manifest = []
+        for key, entries in self._plugins.items():
+            for priority, _, plugin in entries:
+                manifest.append(
+                    {
+                        "name": key,
+                        "target": self._target(plugin),
+                        "aliases": aliases[key],
+                        "priority": priority,
+                    }
+                )
+        pathlib.Path(path).write_text(json.dumps(manifest, indent=2), encoding="utf-8")
+
+    def load_manifest(self, path):
+        """Add plugins from a manifest without importing them"""
+        manifest = json.loads(pathlib.Path(path).read_text(encoding="utf-8"))
+        for plugin in manifest:
+            self.add(
+                plugin["name"],
+                plugin["target"],
+                namespace=plugin.get("namespace"),
+                aliases=plugin.get("aliases", ()),
+                priority=plugin.get("priority", 0),
+            )
+
+    def load_entry_points(self, group, priority=0):
+        """Add plugins from installed packages without importing them"""
+        for entry_point in importlib.metadata.entry_points(group=group):
+            self.add(entry_point.name, entry_point.value, priority=priority)
+
+
+REGISTERED = PluginRegistry()
+
+
+def register(func=None, *, namespace=None, aliases=(), priority=0):
     """Register a function"""
-    REGISTERED[func.__name__] = func
-    return func
 
+    def _register_decorator(func):
+        REGISTERED.add(
+            func.__name__,
+            func,
+            namespace=namespace,
+            aliases=aliases,
+            priority=priority,
+        )
+        return func
 
-def timer(func):
-    """Timing a function"""
+    if func is None:
+        return _register_decorator
+    else:
+        return _register_decorator(func)
 
-    @functools.wraps(func)
-    def _timer(*args, **kwargs):
-        """The timer function replacing the original"""
-        tic = time.perf_counter()
-        value = func(*args, **kwargs)
-        toc = time.perf_counter()
-        print(f"Elapsed time: {toc - tic:.2f} seconds")
-        return value
 
-    return _timer
+def read_lines(*paths):
+    """Read lines lazily from files, or from stdin when no paths are given"""
+    with fileinput.input(paths or ("-",)) as lines:
+        for line in lines:
+            yield line.rstrip("\n")
+
+
+class Pipeline:
+    """Chain of registered parsers, applied from left to right to each line
+
+    The parsers are looked up in the registry once, when the pipeline is
+    created. For example, to parse a large file in parallel processes:
+
+        parse = Pipeline("reversed", "robber_language")
+        for line in parse.map_parallel(read_lines("input.txt")):
+            print(line)
+
+    Parsers are sent to worker processes by reference, so they must be
+    importable. Modules that register them, like task03.py, should only read
+    input inside an if __name__ == "__main__" block.
+    """
+
+    def __init__(self, *names, registry=REGISTERED):
+        self.names = names
+        self.parsers = [registry[name] for name in names]
+
+    def __call__(self, text):
+        for parser in self.parsers:
+            text = parser(text)
+        return text
+
+    def parse_batch(self, texts):
+        return [self(text) for text in texts]
+
+    def map(self, texts):
+        """Parse texts lazily, one at a time"""
+        for text in texts:
+            yield self(text)
+
+    def map_parallel(self, texts, batch_size=10_000, processes=None):
+        """Parse batches of texts in a process pool, keeping their order
+
+        Only a few batches per process are read ahead, so texts can be a lazy
+        iterator over a file that doesn't fit in memory.
+        """
+        processes = processes or os.cpu_count() or 1
+        texts = iter(texts)
+        with concurrent.futures.ProcessPoolExecutor(processes) as executor:
+            pending = collections.deque()
+            while batch := list(itertools.islice(texts, batch_size)):
+                pending.append(executor.submit(self.parse_batch, batch))
+                if len(pending) >= 2 * processes:
+                    yield from pending.popleft().result()
+            while pending:
+                yield from pending.popleft().result()
+
+
+INSTRUMENTATION = os.environ.get("DECORATORS_INSTRUMENT", "1") not in {"0", "off"}
+INSTRUMENTED = collections.defaultdict(list)
+_INSTRUMENTED_LOCK = threading.Lock()
+
+
+def instrumentation(decorator):
+    """Make a decorator follow the instrumentation switch
+
+    When INSTRUMENTATION is off, functions are returned unchanged and cost
+    nothing extra to call. Set the environment variable DECORATORS_INSTRUMENT=0
+    to turn it off when the module is imported. Functions defined in modules
+    and classes are recorded in INSTRUMENTED, so that set_instrumentation()
+    can add or remove the decorators later.
+    """
+
+    @functools.wraps(decorator)
+    def _instrumentation(func):
+        result = decorator(func) if INSTRUMENTATION else func
+        key = (getattr(func, "__module__", None), getattr(func, "__qualname__", ""))
+        if key[0] in sys.modules and "<locals>" not in key[1]:
+            with _INSTRUMENTED_LOCK:
+                INSTRUMENTED[key].append([decorator, func, result])
+        return result
+
+    return _instrumentation
+
+
+def set_instrumentation(enabled):
+    """Turn instrumentation on or off, including for decorated functions
+
+    Functions are decorated again starting from the original function, and
+    rebound in their module or class. Functions that have since been replaced
+    are left alone, as are decorators applied below a decorator that doesn't
+    follow the switch. Names imported elsewhere with from ... import still
+    refer to the old function.
+    """
+    global INSTRUMENTATION
+
+    with _INSTRUMENTED_LOCK:
+        if INSTRUMENTATION == bool(enabled):
+            return
+        INSTRUMENTATION = bool(enabled)
+        for (module_name, qualname), entries in INSTRUMENTED.items():
+            *path, name = qualname.split(".")
+            owner = sys.modules.get(module_name)
+            for part in path:
+                owner = getattr(owner, part, None)
+            if owner is None or vars(owner).get(name) is not entries[-1][2]:
+                continue
+
+            # Follow the chain of decorators applied directly on top of each other
+            chain = [entries[-1]]
+            for entry in reversed(entries[:-1]):
+                if entry[2] is not chain[0][1]:
+                    break
+                chain.insert(0, entry)
+
+            func = chain[0][1]
+            for entry in chain:
+                entry[1] = func
+                entry[2] = func = entry[0](func) if enabled else func
+            setattr(owner, name, func)
+
+
+Hook = collections.namedtuple(
+    "Hook",
+    ["before", "after", "arguments", "attributes"],
+    defaults=[None, None, False, None],
+)
+Hook.__doc__ = """Code to run around calls to a function
+
+before() is called before the function, or before(args, kwargs) if
+arguments is True. Its return value is passed on as after(state, value),
+which is called after the function returns value. Attributes are added to
+the wrapper function.
+"""
+
+
+def compile_wrapper(func, *hooks):
+    """Create a wrapper with exactly the same parameters as func
+
+    Wrappers taking *args and **kwargs create a new tuple and dictionary on
+    every call. Instead, this generates the source code of a wrapper with the
+    parameters of func and compiles it once. Hooks run in order before the
+    call, and in reverse order after it. Functions without an inspectable
+    signature get a regular *args and **kwargs wrapper.
+    """
+    if inspect.isasyncgenfunction(func):
+        raise TypeError("Async generators can't be wrapped with hooks")
+    try:
+        # Use the parameters of func itself, not of a function it wraps
+        parameters = list(
+            inspect.signature(func, follow_wrapped=False).parameters.values()
+        )
+    except (TypeError, ValueError):
+        parameters = [
+            inspect.Parameter("args", inspect.Parameter.VAR_POSITIONAL),
+            inspect.Parameter("kwargs", inspect.Parameter.VAR_KEYWORD),
+        ]
+    if any(parameter.name.startswith("_hook_") for parameter in parameters):
+        raise ValueError("Parameter names can't start with '_hook_'")
+
+    namespace = {"_hook_func": func}
+    signature, call, args, kwargs = [], [], [], []
+    previous = inspect.Parameter.POSITIONAL_OR_KEYWORD
+    for parameter in parameters:
+        name, kind = parameter.name, parameter.kind
+        if previous is parameter.POSITIONAL_ONLY and kind is not previous:
+            signature.append("/")
+        if kind is parameter.KEYWORD_ONLY and previous < parameter.VAR_POSITIONAL:
+            signature.append("*")
+        previous = kind
+
+        if parameter.default is parameter.empty:
+            signature.append(str(parameter.replace(annotation=parameter.empty)))
+        else:
+            namespace[f"_hook_default_{name}"] = parameter.default
+            signature.append(f"{name}=_hook_default_{name}")
+
+        if kind is parameter.VAR_POSITIONAL:
+            call.append(f"*{name}")
+            args.append(f"*{name}")
+        elif kind is parameter.VAR_KEYWORD:
+            call.append(f"**{name}")
+            kwargs.append(f"**{name}")
+        elif kind is parameter.KEYWORD_ONLY:
+            call.append(f"{name}={name}")
+            kwargs.append(f"{name!r}: {name}")
+        else:
+            call.append(name)
+            args.append(name)
+    if parameters and previous is inspect.Parameter.POSITIONAL_ONLY:
+        signature.append("/")
+
+    is_async = inspect.iscoroutinefunction(func)
+    prefix, wait = ("async ", "await ") if is_async else ("", "")
+    lines = [f"{prefix}def _hook_wrapper({', '.join(signature)}):"]
+    for index, hook in enumerate(hooks):
+        if hook.before is None:
+            lines.append(f"    _hook_state_{index} = None")
+            continue
+        namespace[f"_hook_before_{index}"] = hook.before
+        arguments = (
+            f"({', '.join(args)}{',' if len(args) == 1 else ''}), "
+            f"{{{', '.join(kwargs)}}}"
+            if hook.arguments
+            else ""
+        )
+        lines.append(f"    _hook_state_{index} = _hook_before_{index}({arguments})")
+    lines.append(f"    _hook_value = {wait}_hook_func({', '.join(call)})")
+    for index, hook in reversed(list(enumerate(hooks))):
+        if hook.after is not None:
+            namespace[f"_hook_after_{index}"] = hook.after
+            lines.append(f"    _hook_after_{index}(_hook_state_{index}, _hook_value)")
+    lines.append("    return _hook_value")
+
+    exec("\n".join(lines), namespace)
+    wrapper = functools.update_wrapper(namespace["_hook_wrapper"], func)
+    for hook in hooks:
+        wrapper.__dict__.update(hook.attributes or {})
+    return wrapper
+
+
+def fuse(*decorators):
+    """Apply several decorators as one wrapper
+
+    @fuse(timer, trace, count_calls) works like stacking the three decorators,
+    with the first one outermost. Instead of one wrapper per decorator, the
+    hooks of all of them run inside a single wrapper, so the extra cost is
+    about one function call. Only decorators with a .hook attribute can be
+    fused. Fused call counts are read through .counter.value, which also
+    works when count_calls is stacked, instead of through .num_calls.
+    """
+    for decorator in decorators:
+        if not hasattr(decorator, "hook"):
+            raise TypeError(f"{decorator!r} has no hook and can't be fused")
+
+    def _fuse(func):
+        hooks = [decorator.hook(func) for decorator in decorators]
+        return compile_wrapper(func, *hooks)
+
+    return instrumentation(_fuse)
+
+
+class _ThreadExit:
+    """Freed together with the thread-local data of the thread that owns it"""
+
+    __slots__ = ("__weakref__",)
+
+
+class ThreadShards:
+    """Shards of a statistic, one for each thread, merged when threads exit
+
+    Each thread updates its own shard, found in local.shard, without taking a
+    lock. When a thread exits, its shard is merged into the shard of exited
+    threads, so there are never more shards than threads that are alive.
+    """
+
+    def __init__(self, new_shard, merge):
+        self.new_shard = new_shard
+        self.merge = merge
+        self.local = threading.local()
+        self._live = {}
+        self._exited = new_shard()
+        self._keys = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self):
+        """Create the shard of the current thread"""
+        shard = self.local.shard = self.new_shard()
+        thread_exit = self.local.thread_exit = _ThreadExit()
+        key = next(self._keys)
+        with self._lock:
+            self._live[key] = shard
+        weakref.finalize(thread_exit, self._retire, key).atexit = False
+        return shard
+
+    def _retire(self, key):
+        with self._lock:
+            self.merge(self._exited, self._live.pop(key))
+
+    def merged(self):
+        """Merge the shards of all threads, including threads that have exited"""
+        total = self.new_shard()
+        with self._lock:
+            for shard in [self._exited, *self._live.values()]:
+                self.merge(total, shard)
+        return total
+
+
+HISTOGRAMS = {}
+
+
+class LatencyHistogram:
+    """Histogram of latencies in nanoseconds, in the style of HDR histograms
+
+    Values below 64 ns get their own bucket. Larger values are grouped with
+    32 buckets for each power of two, so percentiles are accurate to about 3%.
+    Each thread records into its own buckets, and no lock is taken when
+    recording. The buckets of all threads are added together when reading.
+    """
+
+    NUM_BUCKETS = 32 * 60
+
+    def __init__(self, name):
+        self.name = name
+        self._shards = ThreadShards(self._new_shard, self._merge)
+
+    @classmethod
+    def _new_shard(cls):
+        return ([0] * cls.NUM_BUCKETS, [0, 0])
+
+    @staticmethod
+    def _merge(total, shard):
+        (total_counts, total_ns), (counts, shard_ns) = total, shard
+        total_counts[:] = [a + b for a, b in zip(total_counts, counts)]
+        total_ns[0] += shard_ns[0]
+        total_ns[1] = max(total_ns[1], shard_ns[1])
+
+    def record(self, nanoseconds):
+        try:
+            counts, totals = self._shards.local.shard
+        except AttributeError:
+            counts, totals = self._shards.add()
+        if nanoseconds < 64:
+            counts[nanoseconds] += 1
+        else:
+            shift = nanoseconds.bit_length() - 6
+            counts[((shift + 1) << 5) + (nanoseconds >> shift) - 32] += 1
+        totals[0] += nanoseconds
+        if nanoseconds > totals[1]:
+            totals[1] = nanoseconds
+
+    @staticmethod
+    def _bucket_value(index):
+        """Midpoint of the values stored in a bucket"""
+        if index < 64:
+            return index
+        shift = (index >> 5) - 1
+        low = ((index & 31) + 32) << shift
+        return low + (1 << shift) // 2
+
+    def summary(self, quantiles=(0.5, 0.9, 0.99)):
+        counts, (total_ns, max_ns) = self._shards.merged()
+        count = sum(counts)
+        summary = {"count": count, "sum_ns": total_ns, "max_ns": max_ns}
+        for quantile in quantiles:
+            target, seen, value = quantile * count, 0, 0
+            for index, bucket_count in enumerate(counts):
+                seen += bucket_count
+                if bucket_count and seen >= target:
+                    value = min(self._bucket_value(index), max_ns)
+                    break
+            summary[f"p{quantile * 100:g}_ns"] = value
+        return summary
+
+
+def export_json():
+    """Latency summaries of all timed functions as JSON"""
+    return json.dumps(
+        {name: histogram.summary() for name, histogram in HISTOGRAMS.items()},
+        indent=2,
+    )
+
+
+def export_prometheus():
+    """Latency summaries of all timed functions in Prometheus text format"""
+    lines = ["# TYPE function_latency_seconds summary"]
+    for name, histogram in HISTOGRAMS.items():
+        summary = histogram.summary()
+        for quantile in ("0.5", "0.9", "0.99"):
+            value = summary[f"p{float(quantile) * 100:g}_ns"] / 1e9
+            lines.append(
+                f'function_latency_seconds{{function="{name}",quantile="{quantile}"}}'
+                f" {value:.9f}"
+            )
+        lines.append(
+            f'function_latency_seconds_sum{{function="{name}"}}'
+            f" {summary['sum_ns'] / 1e9:.9f}"
+        )
+        lines.append(
+            f'function_latency_seconds_count{{function="{name}"}} {summary["count"]}'
+        )
+    return "\n".join(lines) + "\n"
+
+
+def timer(func=None, *, metrics=False):
+    """Timing a function
+
+    With metrics=True, nothing is printed. Instead, the timings are collected
+    in a LatencyHistogram available as .histogram and through export_json()
+    and export_prometheus(). Measured with timeit on CPython 3.11, this adds
+    about 800 ns to each call, while printing adds about 2400 ns even when
+    stdout is /dev/null.
+    """
+
+    def _timer_hook(func):
+        if metrics:
+            name = f"{func.__module__}.{func.__qualname__}"
+            histogram = HISTOGRAMS[name] = LatencyHistogram(name)
+            report = histogram.record
+        else:
+            histogram = None
+
+            def report(nanoseconds):
+                print(f"Elapsed time: {nanoseconds / 1e9:.2f} seconds")
+
+        def stop(tic, value):
+            report(time.perf_counter_ns() - tic)
+
+        return Hook(time.perf_counter_ns, stop, attributes={"histogram": histogram})
+
+    def _timer_decorator(func):
+        hook = _timer_hook(func)
+        start, stop = hook.before, hook.after
+
+        if inspect.isasyncgenfunction(func):
+
+            @functools.wraps(func)
+            async def _timer(*args, **kwargs):
+                """The timer function replacing the original async generator"""
+                tic = start()
+                async for value in func(*args, **kwargs):
+                    yield value
+                stop(tic, None)
+
+        elif inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def _timer(*args, **kwargs):
+                """The timer function replacing the original coroutine function"""
+                tic = start()
+                value = await func(*args, **kwargs)
+                stop(tic, value)
+                return value
+
+        else:
+            return compile_wrapper(func, hook)
+
+        _timer.__dict__.update(hook.attributes)
+        return _timer
+
+    _timer_decorator.hook = _timer_hook
+    _timer_decorator = instrumentation(_timer_decorator)
+    if func is None:
+        return _timer_decorator
+    else:
+        return _timer_decorator(func)
 
 
+timer.hook = timer().hook
+
+
+def bounded_repr(maxlen=80):
+    """Create a repr() function that truncates long or deeply nested values"""
+    short_repr = reprlib.Repr()
+    short_repr.maxstring = short_repr.maxother = short_repr.maxlong = maxlen
+    return short_repr.repr
+
+
+@instrumentation
 def trace(func):
     """Show the trace of function calls"""
     name = func.__name__
+    short_repr = bounded_repr()
 
     @functools.wraps(func)
     def _trace(*args, **kwargs):
         """The trace function that replaces the original"""
-        args_repr = [repr(a) for a in args]
-        kwargs_repr = [f"{k}={v!r}" for k, v in kwargs.items()]
+        args_repr = [short_repr(a) for a in args]
+        kwargs_repr = [f"{k}={short_repr(v)}" for k, v in kwargs.items()]
         signature = ", ".join(args_repr + kwargs_repr)
         print(f"Calling {name}({signature})")
         value = func(*args, **kwargs)
-        print(f"{name} returned {value!r}")
+        print(f"{name} returned {short_repr(value)}")
         return value
 
     return _trace
 
 
+def _trace_hook(func):
+    """Trace calls as part of fuse(), with keyword-only arguments shown by name"""
+    name = func.__name__
+    short_repr = bounded_repr()
+
+    def before(args, kwargs):
+        args_repr = [short_repr(a) for a in args]
+        kwargs_repr = [f"{k}={short_repr(v)}" for k, v in kwargs.items()]
+        print(f"Calling {name}({', '.join(args_repr + kwargs_repr)})")
+
+    def after(state, value):
+        print(f"{name} returned {short_repr(value)}")
+
+    return Hook(before, after, arguments=True)
+
+
+trace.hook = _trace_hook
+
+
+SPANS = collections.deque(maxlen=100_000)  # The oldest spans are dropped
+CURRENT_SPAN = contextvars.ContextVar("current_span", default=None)
+SPAN_IDS = itertools.count(1)
+
+
+def current_track():
+    """Identify the asyncio task or thread that is running"""
+    try:
+        task = asyncio.current_task()
+    except RuntimeError:
+        task = None
+    return threading.get_ident() if task is None else id(task)
+
+
+def spantrace(func):
+    """Record the timing of nested calls as spans
+
+    Each call is stored in SPANS together with the call it's nested in. The
+    nesting is tracked separately for each thread and asyncio task. Use
+    export_chrome_trace() to look at the spans in chrome://tracing or Perfetto,
+    and clear_spans() to start over. Only the latest 100,000 spans are kept.
+    """
+    name = func.__qualname__
+
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def _spantrace(*args, **kwargs):
+            """The span function replacing the original coroutine function"""
+            span_id, parent_id = next(SPAN_IDS), CURRENT_SPAN.get()
+            token = CURRENT_SPAN.set(span_id)
+            start = time.perf_counter_ns()
+            try:
+                return await func(*args, **kwargs)
+            finally:
+                end = time.perf_counter_ns()
+                CURRENT_SPAN.reset(token)
+                SPANS.append((name, span_id, parent_id, current_track(), start, end))
+
+    else:
+
+        @functools.wraps(func)
+        def _spantrace(*args, **kwargs):
+            """The span function replacing the original"""
+            span_id, parent_id = next(SPAN_IDS), CURRENT_SPAN.get()
+            token = CURRENT_SPAN.set(span_id)
+            start = time.perf_counter_ns()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                end = time.perf_counter_ns()
+                CURRENT_SPAN.reset(token)
+                SPANS.append((name, span_id, parent_id, current_track(), start, end))
+
+    return _spantrace
+
+
+def clear_spans():
+    """Forget all recorded spans"""
+    SPANS.clear()
+
+
+def export_chrome_trace(path=None, spans=SPANS):
+    """Convert spans to the Chrome trace event format, optionally saved to path"""
+    pid = os.getpid()
+    events = [
+        {
+            "name": name,
+            "ph": "X",
+            "ts": start / 1000,
+            "dur": (end - start) / 1000,
+            "pid": pid,
+            "tid": track,
+            "args": {"span_id": span_id, "parent_id": parent_id},
+        }
+        for name, span_id, parent_id, track, start, end in sorted(
+            spans, key=lambda span: span[4]
+        )
+    ]
+    trace = {"traceEvents": events, "displayTimeUnit": "ns"}
+    if path is not None:
+        pathlib.Path(path).write_text(json.dumps(trace), encoding="utf-8")
+    return trace
+
+
+class ShardedCounter:
+    """Counter that can be incremented from many threads without a lock
+
+    Each thread increments its own shard, so increments are never lost, even
+    on free-threaded Python. The value is the sum of all shards. Resetting
+    stores the current sum as an offset instead of changing the shards.
+    """
+
+    def __init__(self):
+        self._shards = ThreadShards(self._new_shard, self._merge)
+        self._lock = threading.Lock()
+        self._offset = 0
+
+    @staticmethod
+    def _new_shard():
+        return [0]
+
+    @staticmethod
+    def _merge(total, shard):
+        total[0] += shard[0]
+
+    def increment(self):
+        try:
+            self._shards.local.shard[0] += 1
+        except AttributeError:
+            self._shards.add()[0] += 1
+
+    def _total(self):
+        return self._shards.merged()[0]
+
+    @property
+    def value(self):
+        return self._total() - self._offset
+
+    def snapshot(self, reset=False):
+        """Return the current value, and optionally start counting from zero"""
+        with self._lock:
+            total = self._total()
+            value = total - self._offset
+            if reset:
+                self._offset = total
+        return value
+
+    def reset(self):
+        self.snapshot(reset=True)
+
+
+@instrumentation
 def count_calls(func):
-    """Count the number of calls to a function"""
+    """Count the number of calls to a function
+
+    A function attribute can't add up the counts of several threads when it's
+    read, so this uses CountCalls, which provides .num_calls as a property.
+    """
+    return CountCalls(func)
 
-    @functools.wraps(func)
-    def _count_calls(*args, **kwargs):
-        _count_calls.num_calls += 1
-        return func(*args, **kwargs)
 
-    _count_calls.num_calls = 0
-    return _count_calls
+def _count_calls_hook(func):
+    """Count calls as part of fuse()
+
+    A function can't compute .num_calls when it's read, so fused functions
+    only provide .counter, .snapshot(), and .reset(), as CountCalls does.
+    """
+    counter = ShardedCounter()
+    attributes = {
+        "counter": counter,
+        "snapshot": counter.snapshot,
+        "reset": counter.reset,
+    }
+    return Hook(counter.increment, attributes=attributes)
+
+
+count_calls.hook = _count_calls_hook
 
 
 class CountCalls:
     """Count the number of calls to a function"""
 
     def __init__(self, func):
-        self.func = func
-        self.num_calls = 0
+        # Update first, so attributes copied from func don't replace our own
         functools.update_wrapper(self, func)
+        self.func = func
+        self.counter = ShardedCounter()
 
     def __call__(self, *args, **kwargs):
-        self.num_calls += 1
+        self.counter.increment()
         return self.func(*args, **kwargs)
 
+    def __get__(self, instance, owner=None):
+        """Bind to instances, so that methods can be counted"""
+        return self if instance is None else types.MethodType(self, instance)
+
+    @property
+    def num_calls(self):
+        return self.counter.value
+
+    def snapshot(self, reset=False):
+        return self.counter.snapshot(reset=reset)
+
+    def reset(self):
+        self.counter.reset()
+
+
+# Separates positional from keyword arguments in cache keys, so that f(1, a=2)
+# and f(1, ("a", 2)) get different keys
+_KWARGS_MARK = object()
+
+
+class Memoize:
+    """Cache return values, and count the calls made and saved by the cache
+
+    The counters are available as .calls_made.value and .calls_saved.value,
+    also on decorators stacked on top, like @CountCalls.
+    """
+
+    def __init__(self, func):
+        functools.update_wrapper(self, func)
+        self.func = func
+        self.cache = {}
+        self.calls_made = ShardedCounter()
+        self.calls_saved = ShardedCounter()
+
+    def __call__(self, *args, **kwargs):
+        key = (*args, _KWARGS_MARK, *sorted(kwargs.items())) if kwargs else args
+        try:
+            value = self.cache[key]
+        except KeyError:
+            self.calls_made.increment()
+            value = self.cache[key] = self.func(*args, **kwargs)
+        else:
+            self.calls_saved.increment()
+        return value
+
+
+@functools.cache
+def unit_registry():
+    """Create the pint unit registry shared by all units the first time it's used
+
+    Loading the unit definitions is slow, so pint is only imported when needed.
+    """
+    import pint
+
+    return pint.UnitRegistry()
+
+
+class ArrayAttributes:
+    """Attributes of many instances, collected into NumPy arrays when first used
+
+    Only the attributes that are actually read are converted, each one once.
+    Arrays given as keyword arguments are used as they are.
+    """
+
+    def __init__(self, instances, **arrays):
+        self.__dict__.update(arrays)
+        self._instances = instances
+
+    def __getattr__(self, name):
+        # Only called for attributes that haven't been converted yet
+        if name.startswith("__") or name == "_instances":
+            raise AttributeError(name)
+        import numpy as np
+
+        array = np.array([getattr(obj, name) for obj in self._instances])
+        setattr(self, name, array)
+        return array
+
 
 def use_unit(unit):
     """Add units to return values"""
-    use_unit.ureg = pint.UnitRegistry()
 
     def _use_unit_decorator(func):
+        use_unit.ureg = unit_registry()
+        quantity = use_unit.ureg(unit)  # Parse the unit once, not on every call
+
         @functools.wraps(func)
         def _use_unit(*args, **kwargs):
-            return func(*args, **kwargs) * use_unit.ureg(unit)
+            return func(*args, **kwargs) * quantity
+
+        def batch(instances=(), **arrays):
+            """Call a method once for many instances, using NumPy arrays
+
+            The attributes of instances that the method reads are collected
+            into arrays, and the method is called once with an ArrayAttributes
+            object holding these arrays as self. Arrays can also be given
+            directly as keyword arguments:
+
+                Runner.average_speed.batch(runners)
+                Runner.average_speed.batch(distance=distances, duration=durations)
+
+            The result is one pint Quantity array. This only works for methods
+            that do arithmetic on attributes of self. Calling other methods of
+            self, or using if on attribute values, fails on arrays.
+            """
+            return func(ArrayAttributes(list(instances), **arrays)) * quantity
 
         _use_unit.unit = unit
+        _use_unit.batch = batch
         return _use_unit
 
     return _use_unit_decorator
 
 
-def supertrace(func=None, *, logger=print):
+LOG_LEVELS = {
+    "debug": logging.DEBUG,
+    "info": logging.INFO,
+    "warning": logging.WARNING,
+    "warn": logging.WARNING,
+    "error": logging.ERROR,
+    "exception": logging.ERROR,
+    "critical": logging.CRITICAL,
+    "fatal": logging.CRITICAL,
+}
+
+
+def is_enabled(logger):
+    """Create a function checking if logger will output messages
+
+    Logging functions like logging.warning and methods like log.debug are
+    checked against the level of their logger. Other loggers, like print, are
+    always enabled.
+    """
+    level = LOG_LEVELS.get(getattr(logger, "__name__", None))
+    if level is None:
+        return lambda: True
+
+    owner = getattr(logger, "__self__", None)
+    if isinstance(owner, logging.Logger):
+        return functools.partial(owner.isEnabledFor, level)
+    if getattr(logger, "__module__", None) == "logging":
+        return functools.partial(logging.getLogger().isEnabledFor, level)
+    return lambda: True
+
+
+class TraceSink:
+    """Write trace records to a JSON Lines file from a background thread
+
+    Recording a call summarizes the arguments, return value, and exception as
+    short strings, and appends them to a ring buffer, so that no references to
+    the objects themselves are kept. A writer thread appends the records to the
+    file in batches every interval seconds. If calls are recorded faster than
+    they're written, the oldest records are dropped.
+    """
+
+    def __init__(self, path, capacity=100_000, interval=0.5, maxlen=80):
+        self.path = pathlib.Path(path)
+        self.buffer = collections.deque(maxlen=capacity)
+        self.interval = interval
+        self.short_repr = bounded_repr(maxlen)
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self._writer = threading.Thread(target=self._run, name="TraceSink", daemon=True)
+        self._writer.start()
+        atexit.register(self.close)
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self.flush()
+
+    def record(self, name, thread, start_ns, end_ns, args, kwargs, value, error):
+        """Add a summary of one call to the buffer"""
+        short_repr = self.short_repr
+        self.buffer.append(
+            (
+                name,
+                thread,
+                start_ns,
+                end_ns,
+                [short_repr(arg) for arg in args],
+                {key: short_repr(arg) for key, arg in kwargs.items()},
+                None if error is not None else short_repr(value),
+                None if error is None else f"{type(error).__name__}: {error}",
+            )
+        )
+
+    @staticmethod
+    def _format(record):
+        name, thread, start_ns, end_ns, args, kwargs, returned, exception = record
+        return {
+            "function": name,
+            "thread": thread,
+            "start_ns": start_ns,
+            "duration_ns": end_ns - start_ns,
+            "args": args,
+            "kwargs": kwargs,
+            "returned": returned,
+            "exception": exception,
+        }
+
+    def flush(self):
+        """Write all buffered records to the file"""
+        with self._lock:
+            lines = []
+            while self.buffer:
+                lines.append(json.dumps(self._format(self.buffer.popleft())))
+            if lines:
+                with self.path.open(mode="a", encoding="utf-8") as file:
+                    file.write("\n".join(lines) + "\n")
+
+    def close(self):
+        self._closed.set()
+        self._writer.join()
+        self.flush()
+
+
+def supertrace(
+    func=None, *, logger=print, sample=1, sample_rate=1.0, maxlen=80, sink=None
+):
+    """Show the trace of function calls
+
+    Arguments and return values are only formatted when the logger is enabled,
+    and long values are truncated to about maxlen characters. Use sample=N to
+    trace one in N calls, or sample_rate to trace a random fraction of calls.
+
+    With a TraceSink as sink, calls are recorded as structured records that
+    are written by a background thread, instead of being logged.
+    """
+
     def _supertrace_decorator(func):
         """Show the trace of function calls"""
         name = func.__name__
+        enabled = is_enabled(logger)
+        short_repr = bounded_repr(maxlen)
+        counter = itertools.count()
+        record = None if sink is None else sink.record
 
         @functools.wraps(func)
         def _supertrace(*args, **kwargs):
             """The trace function that replaces the original"""
-            args_repr = [repr(a) for a in args]
-            kwargs_repr = [f"{k}={v!r}" for k, v in kwargs.items()]
+            if (sample > 1 and next(counter) % sample) or (
+                sample_rate < 1 and random.random() >= sample_rate
+            ):
+                return func(*args, **kwargs)
+
+            if record is not None:
+                thread, start = threading.get_ident(), time.time_ns()
+                try:
+                    value = func(*args, **kwargs)
+                except BaseException as error:
+                    end = time.time_ns()
+                    record(name, thread, start, end, args, kwargs, None, error)
+                    raise
+                end = time.time_ns()
+                record(name, thread, start, end, args, kwargs, value, None)
+                return value
+
+            if not enabled():
+                return func(*args, **kwargs)
+
+            args_repr = [short_repr(a) for a in args]
+            kwargs_repr = [f"{k}={short_repr(v)}" for k, v in kwargs.items()]
             signature = ", ".join(args_repr + kwargs_repr)
             logger(f"Calling {name}({signature})")
             value = func(*args, **kwargs)
-            logger(f"{name} returned {value!r}")
+            logger(f"{name} returned {short_repr(value)}")
             return value
 
         return _supertrace
 
+    _supertrace_decorator = instrumentation(_supertrace_decorator)
     if func is None:
         return _supertrace_decorator
     else:
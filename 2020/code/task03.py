@@ -27,12 +27,13 @@ def robber_language(text):
     return "".join(f"{c}o{c.lower()}" if c.lower() in consonants else c for c in text)
 
 
-text = input("Please input a text: ")
-while True:
-    print(f"Parsers: {', '.join(REGISTERED)}")
-    parser = input("Choose a parser: ")
-    if parser in REGISTERED:
-        break
-
-parser_func = REGISTERED[parser]
-print(parser_func(text))
+if __name__ == "__main__":
+    text = input("Please input a text: ")
+    while True:
+        print(f"Parsers: {', '.join(REGISTERED)}")
+        parser = input("Choose a parser: ")
+        if parser in REGISTERED:
+            break
+
+    parser_func = REGISTERED[parser]
+    print(parser_func(text))
@@ -1,4 +1,7 @@
+import asyncio
 import functools
+import inspect
+import threading
 
 
 # Introduction
@@ -40,11 +43,29 @@ def params(*args, **kwargs):
 
 
 def before_and_after(func):
-    def wrapper(*args, **kwargs):
-        print("BEFORE")
-        value = func(*args, **kwargs)
-        print("AFTER")
-        return value
+    if inspect.isasyncgenfunction(func):
+
+        async def wrapper(*args, **kwargs):
+            print("BEFORE")
+            async for value in func(*args, **kwargs):
+                yield value
+            print("AFTER")
+
+    elif inspect.iscoroutinefunction(func):
+
+        async def wrapper(*args, **kwargs):
+            print("BEFORE")
+            value = await func(*args, **kwargs)
+            print("AFTER")
+            return value
+
+    else:
+
+        def wrapper(*args, **kwargs):
+            print("BEFORE")
+            value = func(*args, **kwargs)
+            print("AFTER")
+            return value
 
     return wrapper
 
@@ -74,11 +95,30 @@ def register(func):
 
 
 def do_twice(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        first = func(*args, **kwargs)
-        second = func(*args, **kwargs)
-        return first, second
+    if inspect.isasyncgenfunction(func):
+        # Async generators yield the values of both runs, one after the other
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            async for value in func(*args, **kwargs):
+                yield value
+            async for value in func(*args, **kwargs):
+                yield value
+
+    elif inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            first = await func(*args, **kwargs)
+            second = await func(*args, **kwargs)
+            return first, second
+
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            first = func(*args, **kwargs)
+            second = func(*args, **kwargs)
+            return first, second
 
     return wrapper
 
@@ -136,15 +176,61 @@ def retry_3(max_retries):
 
 def retry_4(max_retries):
     def decorator(func):
-        @functools.wraps(func)
-        def wrapper(*args, **kwargs):
-            for _ in range(max_retries - wrapper.num_retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    print(f"Retrying ({e})")
-                    wrapper.num_retries += 1
-            return func(*args, **kwargs)
+        # Every call gets max_retries retries. num_retries counts the retries
+        # across all calls, and is protected by a lock as threads may share it
+        lock = threading.Lock()
+
+        def count_retry():
+            with lock:
+                wrapper.num_retries += 1
+
+        if inspect.isasyncgenfunction(func):
+            # Only retry until the first value is yielded, as the caller would
+            # see duplicated values if the generator was restarted after that
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                for _ in range(max_retries):
+                    values = func(*args, **kwargs)
+                    try:
+                        first = await values.__anext__()
+                    except StopAsyncIteration:
+                        return
+                    except Exception as e:
+                        print(f"Retrying ({e})")
+                        count_retry()
+                        await asyncio.sleep(0)
+                    else:
+                        yield first
+                        async for value in values:
+                            yield value
+                        return
+                async for value in func(*args, **kwargs):
+                    yield value
+
+        elif inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                for _ in range(max_retries):
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception as e:
+                        print(f"Retrying ({e})")
+                        count_retry()
+                        await asyncio.sleep(0)  # Let other tasks run
+                return await func(*args, **kwargs)
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                for _ in range(max_retries):
+                    try:
+                        return func(*args, **kwargs)
+                    except Exception as e:
+                        print(f"Retrying ({e})")
+                        count_retry()
+                return func(*args, **kwargs)
 
         wrapper.num_retries = 0
         return wrapper
@@ -1,5 +1,23 @@
+import asyncio
+import collections
+import concurrent.futures
 import functools
+import hashlib
+import importlib
+import inspect
+import itertools
+import math
+import os
+import pathlib
+import pickle
+import random
+import sqlite3
+import sys
+import threading
 import time
+import types
+import typing
+import weakref
 
 
 #
@@ -61,10 +79,27 @@ def do_twice_1(func):
 
 
 def do_twice(func):
-    def wrapper(*args, **kwargs):
-        first = func(*args, **kwargs)
-        second = func(*args, **kwargs)
-        return first, second
+    if inspect.isasyncgenfunction(func):
+        # Async generators yield the values of both runs, one after the other
+        async def wrapper(*args, **kwargs):
+            async for value in func(*args, **kwargs):
+                yield value
+            async for value in func(*args, **kwargs):
+                yield value
+
+    elif inspect.iscoroutinefunction(func):
+
+        async def wrapper(*args, **kwargs):
+            first = await func(*args, **kwargs)
+            second = await func(*args, **kwargs)
+            return first, second
+
+    else:
+
+        def wrapper(*args, **kwargs):
+            first = func(*args, **kwargs)
+            second = func(*args, **kwargs)
+            return first, second
 
     return wrapper
 
@@ -89,12 +124,32 @@ def before_and_after_4(func):
 
 
 def before_and_after(func):
-    @functools.wraps(func)
-    def wrapper(*args, **kwargs):
-        print("BEFORE")
-        value = func(*args, **kwargs)
-        print("AFTER")
-        return value
+    if inspect.isasyncgenfunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            print("BEFORE")
+            async for value in func(*args, **kwargs):
+                yield value
+            print("AFTER")
+
+    elif inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            print("BEFORE")
+            value = await func(*args, **kwargs)
+            print("AFTER")
+            return value
+
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            print("BEFORE")
+            value = func(*args, **kwargs)
+            print("AFTER")
+            return value
 
     return wrapper
 
@@ -174,20 +229,1084 @@ def retry_4(max_retries):
     return decorator
 
 
-def retry(max_retries):
+class _Backoff:
+    """Delays between the attempts of one call to a retried function"""
+
+    def __init__(self, delay, backoff, max_delay, jitter, stop):
+        self.delay = self.previous = delay
+        self.backoff = backoff
+        self.max_delay = math.inf if max_delay is None else max_delay
+        self.jitter = jitter
+        self.stop = stop  # In time.perf_counter() seconds, or None
+
+    def next_pause(self):
+        """Return the next delay, or None if it would pass the deadline"""
+        if self.jitter == "decorrelated":
+            pause = self.previous = min(
+                self.max_delay, random.uniform(self.delay, self.previous * 3)
+            )
+        else:
+            pause = min(self.max_delay, self.delay)
+            self.delay = pause * self.backoff
+            if self.jitter == "full":
+                pause = random.uniform(0, pause)
+
+        if self.stop is not None and time.perf_counter() + pause > self.stop:
+            return None
+        return pause
+
+
+class _ThreadExit:
+    """Freed together with the thread-local data of the thread that owns it"""
+
+    __slots__ = ("__weakref__",)
+
+
+class ThreadShards:
+    """Shards of a statistic, one for each thread, merged when threads exit
+
+    Each thread updates its own shard, found in local.shard, without taking a
+    lock. When a thread exits, its shard is merged into the shard of exited
+    threads, so there are never more shards than threads that are alive.
+    """
+
+    def __init__(self, new_shard, merge):
+        self.new_shard = new_shard
+        self.merge = merge
+        self.local = threading.local()
+        self._live = {}
+        self._exited = new_shard()
+        self._keys = itertools.count()
+        self._lock = threading.Lock()
+
+    def add(self):
+        """Create the shard of the current thread"""
+        shard = self.local.shard = self.new_shard()
+        thread_exit = self.local.thread_exit = _ThreadExit()
+        key = next(self._keys)
+        with self._lock:
+            self._live[key] = shard
+        weakref.finalize(thread_exit, self._retire, key).atexit = False
+        return shard
+
+    def _retire(self, key):
+        with self._lock:
+            self.merge(self._exited, self._live.pop(key))
+
+    def merged(self):
+        """Merge the shards of all threads, including threads that have exited"""
+        total = self.new_shard()
+        with self._lock:
+            for shard in [self._exited, *self._live.values()]:
+                self.merge(total, shard)
+        return total
+
+
+class RetryMetrics:
+    """Aggregated statistics for a retried function
+
+    Each thread records into its own shard, so no lock is taken when calling
+    the function. Reading the statistics sums all shards, and may miss
+    attempts that are still being recorded.
+    """
+
+    def __init__(self):
+        self._shards = ThreadShards(self._new_shard, self._merge)
+
+    @staticmethod
+    def _new_shard():
+        return {
+            "attempts": 0,
+            "successes": 0,
+            "retries": 0,
+            "give_ups": 0,
+            "attempt_seconds": 0.0,
+            "max_attempt_seconds": 0.0,
+        }
+
+    @staticmethod
+    def _merge(total, shard):
+        for field, value in shard.items():
+            if field == "max_attempt_seconds":
+                total[field] = max(total[field], value)
+            else:
+                total[field] += value
+
+    def _shard(self):
+        try:
+            return self._shards.local.shard
+        except AttributeError:
+            return self._shards.add()
+
+    def record_attempt(self, seconds, success):
+        shard = self._shard()
+        shard["attempts"] += 1
+        shard["attempt_seconds"] += seconds
+        if seconds > shard["max_attempt_seconds"]:
+            shard["max_attempt_seconds"] = seconds
+        if success:
+            shard["successes"] += 1
+
+    def record_retry(self):
+        self._shard()["retries"] += 1
+
+    def record_give_up(self):
+        self._shard()["give_ups"] += 1
+
+    def snapshot(self):
+        totals = self._shards.merged()
+        attempts = totals["attempts"]
+        totals["mean_attempt_seconds"] = (
+            totals["attempt_seconds"] / attempts if attempts else 0.0
+        )
+        return totals
+
+
+class RetryBudget:
+    """Token bucket limiting retries across several retried functions
+
+    Each successful call deposits ratio tokens, and each retry withdraws one
+    token. In addition, min_per_second tokens are added every second, so that
+    a few retries are allowed even when no calls succeed. When the bucket is
+    empty, retried functions fail immediately instead of adding more load.
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=1, max_tokens=10):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(
+            self.max_tokens,
+            self.tokens + (now - self._last_refill) * self.min_per_second,
+        )
+        self._last_refill = now
+
+    def deposit(self):
+        with self._lock:
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            self._refill()
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+            return True
+
+
+# Wait delay seconds before the first retry, and multiply the delay by backoff
+# for each following retry, up to max_delay. Use jitter="full" or
+# "decorrelated" to spread out retries, and deadline=seconds to limit the total
+# time spent on one call. After the final attempt, the error is raised.
+#
+# Each call gets max_retries attempts. Statistics across all calls are
+# available through .metrics.snapshot(). Pass a shared RetryBudget as budget
+# to limit the total number of retries of several functions
+def retry(
+    max_retries,
+    *,
+    exceptions=Exception,
+    delay=0,
+    backoff=2,
+    max_delay=None,
+    jitter=None,
+    deadline=None,
+    budget=None,
+):
+    if max_retries < 1:
+        raise ValueError("max_retries must be at least 1")
+    if jitter not in {None, "full", "decorrelated"}:
+        raise ValueError(f"Unknown jitter {jitter!r}")
+
+    def decorator(func):
+        metrics = RetryMetrics()
+
+        # Only called after the first failure, so that calls that succeed right
+        # away don't pay for it. The deadline counts from the first attempt
+        def start_backoff(start):
+            stop = None if deadline is None else start + deadline
+            return _Backoff(delay, backoff, max_delay, jitter, stop)
+
+        def record_success(tic):
+            metrics.record_attempt(time.perf_counter() - tic, True)
+            if budget is not None:
+                budget.deposit()
+
+        def retry_pause(error, attempt, delays, tic):
+            metrics.record_attempt(time.perf_counter() - tic, False)
+            if attempt == max_retries:
+                print(f"{max_retries} retries done")
+                metrics.record_give_up()
+                return None
+            pause = delays.next_pause()
+            if pause is None:
+                print(f"Deadline reached for {func.__name__}")
+                metrics.record_give_up()
+                return None
+            if isinstance(error, CircuitOpenError):
+                print(f"Circuit open for {func.__name__}")
+                metrics.record_give_up()
+                return None
+            if budget is not None and not budget.withdraw():
+                print(f"Retry budget exhausted for {func.__name__}")
+                metrics.record_give_up()
+                return None
+            print(f"{attempt}: Retrying {func.__name__} ({error})")
+            metrics.record_retry()
+            return pause
+
+        if inspect.isasyncgenfunction(func):
+            # Only retry until the first value is yielded, as the caller would
+            # see duplicated values if the generator was restarted after that
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                delays, start = None, time.perf_counter()
+                for attempt in range(1, max_retries + 1):
+                    tic = start if attempt == 1 else time.perf_counter()
+                    values = func(*args, **kwargs)
+                    try:
+                        first = await values.__anext__()
+                    except StopAsyncIteration:
+                        record_success(tic)
+                        return
+                    except exceptions as e:
+                        delays = delays or start_backoff(start)
+                        pause = retry_pause(e, attempt, delays, tic)
+                        if pause is None:
+                            raise
+                        await asyncio.sleep(pause)
+                    else:
+                        record_success(tic)
+                        yield first
+                        async for value in values:
+                            yield value
+                        return
+
+        elif inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                delays, start = None, time.perf_counter()
+                for attempt in range(1, max_retries + 1):
+                    tic = start if attempt == 1 else time.perf_counter()
+                    try:
+                        value = await func(*args, **kwargs)
+                    except exceptions as e:
+                        delays = delays or start_backoff(start)
+                        pause = retry_pause(e, attempt, delays, tic)
+                        if pause is None:
+                            raise
+                        await asyncio.sleep(pause)  # Let other tasks run
+                    else:
+                        record_success(tic)
+                        return value
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                delays, start = None, time.perf_counter()
+                for attempt in range(1, max_retries + 1):
+                    tic = start if attempt == 1 else time.perf_counter()
+                    try:
+                        value = func(*args, **kwargs)
+                    except exceptions as e:
+                        delays = delays or start_backoff(start)
+                        pause = retry_pause(e, attempt, delays, tic)
+                        if pause is None:
+                            raise
+                        if pause:
+                            time.sleep(pause)
+                    else:
+                        record_success(tic)
+                        return value
+
+        wrapper.metrics = metrics
+        return wrapper
+
+    return decorator
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling a function while its circuit is open"""
+
+
+class CircuitBreaker:
+    """Stop calling a failing function until it has had time to recover
+
+    The circuit starts closed, and calls go through as usual. When at least
+    failure_rate of the last window calls have failed, the circuit opens and
+    calls raise CircuitOpenError immediately. After cooldown seconds, the
+    circuit is half-open and one trial call is let through. If it succeeds,
+    the circuit closes, otherwise it opens again. If the trial call hasn't
+    finished after trial_timeout seconds, which defaults to cooldown, another
+    trial call is let through.
+
+    Exceptions, and cancelled coroutines, which is how asyncio.wait_for() and
+    asyncio.timeout() stop calls that take too long, count as failures. Other
+    ways of leaving a call, like KeyboardInterrupt, aren't counted. One
+    breaker can decorate several functions that depend on the same service.
+    Stack it below @retry to check the circuit on each attempt. @retry gives
+    up as soon as the circuit opens.
+    """
+
+    def __init__(
+        self,
+        failure_rate=0.5,
+        window=20,
+        min_calls=5,
+        cooldown=30,
+        exceptions=Exception,
+        trial_timeout=None,
+    ):
+        self.failure_rate = failure_rate
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.trial_timeout = cooldown if trial_timeout is None else trial_timeout
+        self.exceptions = exceptions
+        self.state = "closed"
+        self.results = collections.deque(maxlen=window)
+        self.opened_at = self.trial_started = None
+        self._trial = None
+        self._lock = threading.Lock()
+
+    def __call__(self, func):
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                trial = self._before_call()
+                try:
+                    value = await func(*args, **kwargs)
+                except self.exceptions:
+                    self._record(False, trial)
+                    raise
+                except asyncio.CancelledError:
+                    self._record(False, trial)
+                    raise
+                except BaseException:
+                    self._release(trial)
+                    raise
+                self._record(True, trial)
+                return value
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                trial = self._before_call()
+                try:
+                    value = func(*args, **kwargs)
+                except self.exceptions:
+                    self._record(False, trial)
+                    raise
+                except BaseException:
+                    self._release(trial)
+                    raise
+                self._record(True, trial)
+                return value
+
+        wrapper.breaker = self
+        return wrapper
+
+    def _before_call(self):
+        """Check the circuit, and return a token if this is the trial call"""
+        if self.state == "closed":
+            return None
+        with self._lock:
+            now = time.monotonic()
+            if self.state == "closed":
+                return None
+            if self.state == "open" and now - self.opened_at < self.cooldown:
+                raise CircuitOpenError(f"Circuit open for {self.cooldown} seconds")
+            if self.state == "half-open" and (
+                now - self.trial_started < self.trial_timeout
+            ):
+                raise CircuitOpenError("Waiting for trial call")
+            self.state, self.trial_started = "half-open", now
+            self._trial = trial = object()
+            return trial
+
+    def _record(self, success, trial):
+        with self._lock:
+            # Only the current trial call decides the half-open state. Calls
+            # that started before the circuit opened, or trial calls that took
+            # longer than trial_timeout, are only added to the window
+            if trial is not None and trial is self._trial:
+                self._trial = None
+                self.results.clear()
+                if success:
+                    self.state = "closed"
+                else:
+                    self._open()
+                return
+
+            self.results.append(success)
+            failures = self.results.count(False)
+            if (
+                self.state == "closed"
+                and len(self.results) >= self.min_calls
+                and failures >= self.failure_rate * len(self.results)
+            ):
+                self._open()
+
+    def _release(self, trial):
+        """Open the circuit again if the trial call ended without a result"""
+        with self._lock:
+            if trial is not None and trial is self._trial:
+                # The cooldown has passed, so the next call is a new trial
+                self._trial = None
+                self.state = "open"
+
+    def _open(self):
+        self.state = "open"
+        self.opened_at = time.monotonic()
+
+    def reset(self):
+        with self._lock:
+            self.state = "closed"
+            self.results.clear()
+            self._trial = None
+
+
+#
+# Concurrency
+#
+
+
+def _call_in_process(module_name, qualname, args, kwargs):
+    # The decorated function can't be pickled as it has the same name as the
+    # wrapper, so look up the original function through the wrapper instead
+    func = importlib.import_module(module_name)
+    for name in qualname.split("."):
+        func = getattr(func, name)
+    return func._do_n_original(*args, **kwargs)
+
+
+def _collect(futures, ordered):
+    """Wait for futures, and cancel the rest as soon as one fails"""
+    results, completed = [None] * len(futures), []
+    indices = {future: index for index, future in enumerate(futures)}
+    try:
+        for future in concurrent.futures.as_completed(futures):
+            results[indices[future]] = future.result()
+            completed.append(results[indices[future]])
+    except BaseException:
+        for future in futures:
+            future.cancel()
+        raise
+    return tuple(results if ordered else completed)
+
+
+# Call the decorated function n times, and return a tuple with all results.
+# Use executor="thread" or "process" to run the calls in a pool, or pass your
+# own concurrent.futures.Executor. Coroutine functions run as asyncio tasks.
+# With ordered=False, results are returned in the order they complete. If one
+# call fails, calls that haven't started are cancelled and the error is raised
+def do_n(n, executor=None, ordered=True):
     def decorator(func):
+        if inspect.iscoroutinefunction(func):
+            if executor not in {None, "asyncio"}:
+                raise TypeError("Coroutine functions can only run as asyncio tasks")
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                tasks = [asyncio.create_task(func(*args, **kwargs)) for _ in range(n)]
+                results, completed = [None] * n, []
+                try:
+                    for task in asyncio.as_completed(tasks):
+                        completed.append(await task)
+                except BaseException:
+                    for task in tasks:
+                        task.cancel()
+                    raise
+                for index, task in enumerate(tasks):
+                    results[index] = task.result()
+                return tuple(results if ordered else completed)
+
+            return wrapper
+
+        pool = None
+        lock = threading.Lock()
+
+        def get_pool():
+            nonlocal pool
+            if not isinstance(executor, str):
+                return executor
+            with lock:
+                if pool is None and executor == "thread":
+                    pool = concurrent.futures.ThreadPoolExecutor(max_workers=n)
+                elif pool is None and executor == "process":
+                    pool = concurrent.futures.ProcessPoolExecutor(max_workers=n)
+            return pool
+
+        if executor not in {None, "thread", "process"} and not isinstance(
+            executor, concurrent.futures.Executor
+        ):
+            raise ValueError(f"Unknown executor {executor!r}")
+
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
-            for _ in range(max_retries - wrapper.num_retries):
-                try:
-                    return func(*args, **kwargs)
-                except Exception as e:
-                    print(f"{wrapper.num_retries}: Retrying {func.__name__} ({e})")
-                    wrapper.num_retries += 1
+            if executor is None:
+                return tuple(func(*args, **kwargs) for _ in range(n))
+
+            workers = get_pool()
+            if isinstance(workers, concurrent.futures.ProcessPoolExecutor):
+                call = (_call_in_process, func.__module__, func.__qualname__)
+                futures = [workers.submit(*call, args, kwargs) for _ in range(n)]
             else:
-                print(f"{max_retries} retries done")
+                futures = [workers.submit(func, *args, **kwargs) for _ in range(n)]
+            return _collect(futures, ordered)
 
-        wrapper.num_retries = 0
+        wrapper._do_n_original = func
         return wrapper
 
     return decorator
+
+
+#
+# Monte Carlo simulations
+#
+
+
+# Give a scalar random function, like roll_dice(), a vectorized .trials(size)
+# companion. sampler(rng, size) should draw size values at once from a NumPy
+# Generator. With accept(values), rejected trials are drawn again using an
+# array mask, which is how @retry works for a single call. The decorated
+# function itself is returned unchanged
+def monte_carlo(sampler, accept=None, max_retries=None):
+    def decorator(func):
+        def trials(size, seed=None):
+            import numpy as np
+
+            rng = np.random.default_rng(seed)
+            values = sampler(rng, size)
+            if accept is None:
+                return values
+
+            rejected = ~accept(values)
+            for attempt in itertools.count(1):
+                num_rejected = int(rejected.sum())
+                if not num_rejected:
+                    return values
+                if max_retries is not None and attempt >= max_retries:
+                    raise ValueError(
+                        f"{num_rejected} trials rejected after {max_retries} tries"
+                    )
+                values[rejected] = sampler(rng, num_rejected)
+                rejected[rejected] = ~accept(values[rejected])
+
+        func.trials = trials
+        return func
+
+    return decorator
+
+
+#
+# Caching
+#
+CacheInfo = collections.namedtuple(
+    "CacheInfo", ["hits", "misses", "evictions", "maxsize", "currsize"]
+)
+
+
+class _MemoCache:
+    """Bounded cache with LRU or LFU eviction and optional time-to-live
+
+    Every operation takes constant time. For LFU, keys are kept in one bucket
+    per number of uses, so the least used key is found without a scan. All
+    entries live for the same ttl, so they expire in the order they were
+    stored, and expired entries are only looked for at the front of that order.
+    """
+
+    def __init__(self, maxsize, policy, ttl):
+        if policy not in {"lru", "lfu"}:
+            raise ValueError(f"Unknown eviction policy {policy!r}")
+        # As with functools.lru_cache, a maxsize of 0 or less stores nothing
+        self.maxsize = maxsize if maxsize is None else max(maxsize, 0)
+        self.policy = policy
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()  # key -> value, in LRU order
+        self.expiry = collections.OrderedDict()  # key -> expiry time, oldest first
+        self.uses = {}  # key -> number of uses, only for LFU
+        self.buckets = {}  # number of uses -> keys, least recently used first
+        self.min_uses = 0
+        self.hits = self.misses = self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            if key in self.entries:
+                if self.ttl is None or self.expiry[key] > time.monotonic():
+                    self._use(key)
+                    self.hits += 1
+                    return True, self.entries[key]
+                self._remove(key)
+                self.evictions += 1
+            self.misses += 1
+            return False, None
+
+    def put(self, key, value):
+        if self.maxsize == 0:
+            return
+        with self.lock:
+            if key in self.entries:
+                self._remove(key)
+            elif self.maxsize is not None and len(self.entries) >= self.maxsize:
+                self._evict()
+            self.entries[key] = value
+            if self.ttl is not None:
+                self.expiry[key] = time.monotonic() + self.ttl
+            if self.policy == "lfu":
+                self.uses[key] = 1
+                self.buckets.setdefault(1, collections.OrderedDict())[key] = None
+                self.min_uses = 1
+
+    def invalidate(self, key):
+        with self.lock:
+            if key not in self.entries:
+                return False
+            self._remove(key)
+            return True
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.expiry.clear()
+            self.uses.clear()
+            self.buckets.clear()
+            self.min_uses = 0
+
+    def info(self):
+        with self.lock:
+            return CacheInfo(
+                self.hits, self.misses, self.evictions, self.maxsize, len(self.entries)
+            )
+
+    def _use(self, key):
+        if self.policy == "lru":
+            self.entries.move_to_end(key)
+            return
+
+        uses = self.uses[key]
+        bucket = self.buckets[uses]
+        del bucket[key]
+        if not bucket:
+            del self.buckets[uses]
+            if self.min_uses == uses:
+                self.min_uses = uses + 1
+        self.uses[key] = uses + 1
+        self.buckets.setdefault(uses + 1, collections.OrderedDict())[key] = None
+
+    def _remove(self, key):
+        del self.entries[key]
+        self.expiry.pop(key, None)
+        if self.policy == "lfu":
+            uses = self.uses.pop(key)
+            bucket = self.buckets[uses]
+            del bucket[key]
+            if not bucket:
+                del self.buckets[uses]
+
+    def _evict(self):
+        if self.ttl is not None:
+            now, expired = time.monotonic(), 0
+            while self.expiry and next(iter(self.expiry.values())) <= now:
+                self._remove(next(iter(self.expiry)))
+                expired += 1
+            if expired:
+                self.evictions += expired
+                return
+
+        if self.policy == "lru":
+            key = next(iter(self.entries))
+        else:
+            if self.min_uses not in self.buckets:
+                # The least used keys have been invalidated or have expired
+                self.min_uses = min(self.buckets)
+            key = next(iter(self.buckets[self.min_uses]))
+        self._remove(key)
+        self.evictions += 1
+
+
+# Separates positional from keyword arguments, so that f(1, a=2) and
+# f(1, ("a", 2)) get different keys
+_KWARGS_MARK = object()
+
+
+def _make_key(args, kwargs):
+    return (*args, _KWARGS_MARK, *sorted(kwargs.items())) if kwargs else args
+
+
+class _InFlight:
+    """A computation that concurrent callers with the same key can wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.value = None
+        self.error = None
+
+    def result(self):
+        self.done.wait()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+
+# A bounded alternative to @functools.cache. Use policy="lru" or "lfu", and
+# ttl=seconds to let entries expire. Statistics are available through
+# .cache_info(), and single entries can be dropped with .invalidate(*args).
+# With coalesce=True, concurrent calls with the same arguments share one
+# computation instead of all missing the cache at the same time
+def memoize(maxsize=128, policy="lru", ttl=None, coalesce=False):
+    def decorator(func):
+        cache = _MemoCache(maxsize, policy, ttl)
+        in_flight = {}
+        lock = threading.Lock()
+
+        def finish(key, task):
+            del in_flight[key]
+            if not task.cancelled() and task.exception() is None:
+                cache.put(key, task.result())
+
+        if inspect.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def wrapper(*args, **kwargs):
+                key = _make_key(args, kwargs)
+                found, value = cache.get(key)
+                if found:
+                    return value
+                if not coalesce:
+                    value = await func(*args, **kwargs)
+                    cache.put(key, value)
+                    return value
+
+                # The computation runs in its own task, so that cancelling any
+                # of the callers doesn't cancel it for the others
+                task = in_flight.get(key)
+                if task is None:
+                    task = in_flight[key] = asyncio.ensure_future(func(*args, **kwargs))
+                    task.add_done_callback(functools.partial(finish, key))
+                return await asyncio.shield(task)
+
+        else:
+
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                key = _make_key(args, kwargs)
+                if not coalesce:
+                    found, value = cache.get(key)
+                    if found:
+                        return value
+                    value = func(*args, **kwargs)
+                    cache.put(key, value)
+                    return value
+
+                with lock:
+                    found, value = cache.get(key)
+                    if found:
+                        return value
+                    call = in_flight.get(key)
+                    if call is None:
+                        call = in_flight[key] = _InFlight()
+                        is_leader = True
+                    else:
+                        is_leader = False
+                if not is_leader:
+                    return call.result()
+
+                try:
+                    call.value = func(*args, **kwargs)
+                    cache.put(key, call.value)
+                    return call.value
+                except BaseException as e:
+                    call.error = e
+                    raise
+                finally:
+                    with lock:
+                        del in_flight[key]
+                    call.done.set()
+
+        def invalidate(*args, **kwargs):
+            return cache.invalidate(_make_key(args, kwargs))
+
+        wrapper.cache_info = cache.info
+        wrapper.cache_clear = cache.clear
+        wrapper.invalidate = invalidate
+        return wrapper
+
+    return decorator
+
+
+def _normalize(value):
+    """Replace sets and dicts with sorted lists, so they pickle the same way in
+    every process, whatever the order of their items"""
+    if type(value) in (tuple, list):
+        return (type(value).__name__, [_normalize(item) for item in value])
+    if type(value) in (set, frozenset):
+        return (type(value).__name__, sorted(_stable_pickle(item) for item in value))
+    if type(value) is dict:
+        items = [(_stable_pickle(key), _normalize(item)) for key, item in value.items()]
+        return ("dict", sorted(items, key=lambda item: item[0]))
+    return value
+
+
+def _stable_pickle(value):
+    return pickle.dumps(_normalize(value), protocol=4)
+
+
+# Store results in a SQLite database inside directory so that they survive
+# restarts. Keys are a hash of the function's qualified name, version, and
+# arguments, which is the same in all processes for arguments built from
+# None, bool, numbers, strings, bytes, tuples, lists, dicts, sets, and
+# frozensets. Other arguments are pickled as they are, which only gives stable
+# keys if their pickles don't depend on the process. Bump version to ignore
+# entries written by older code, and call .prune() once older versions are no
+# longer running to delete them. Each thread keeps its own connection
+def persistent_memoize(directory=".cache", version=1):
+    path = pathlib.Path(directory) / "memoize.sqlite"
+    local = threading.local()
+
+    def connect():
+        # Connections can't be shared with processes forked from this one
+        if getattr(local, "pid", None) != os.getpid():
+            local.connection = sqlite3.connect(path, timeout=30, isolation_level=None)
+            local.pid = os.getpid()
+        return local.connection
+
+    def decorator(func):
+        name = f"{func.__module__}.{func.__qualname__}"
+
+        path.parent.mkdir(parents=True, exist_ok=True)
+        connection = connect()
+        connection.execute("PRAGMA journal_mode=WAL")
+        connection.execute(
+            "CREATE TABLE IF NOT EXISTS cache ("
+            " key TEXT PRIMARY KEY, function TEXT, version INTEGER, value BLOB)"
+        )
+
+        def make_key(args, kwargs):
+            data = _stable_pickle((name, version, args, kwargs))
+            return hashlib.sha256(data).hexdigest()
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            key = make_key(args, kwargs)
+            row = (
+                connect()
+                .execute(
+                    "SELECT value FROM cache WHERE key = ? AND version = ?",
+                    (key, version),
+                )
+                .fetchone()
+            )
+            if row is not None:
+                return pickle.loads(row[0])
+
+            value = func(*args, **kwargs)
+            connect().execute(
+                "INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?)",
+                (key, name, version, pickle.dumps(value)),
+            )
+            return value
+
+        def invalidate(*args, **kwargs):
+            cursor = connect().execute(
+                "DELETE FROM cache WHERE key = ?", (make_key(args, kwargs),)
+            )
+            return cursor.rowcount > 0
+
+        # Entries of other versions are left alone, as processes running older
+        # or newer code may still be using them. This removes all of them
+        def cache_clear():
+            connect().execute("DELETE FROM cache WHERE function = ?", (name,))
+
+        # Delete entries of versions older than this one, except for the keep
+        # newest of them. Return the number of deleted entries
+        def prune(keep=0):
+            older = connect().execute(
+                "SELECT DISTINCT version FROM cache"
+                " WHERE function = ? AND version < ? ORDER BY version DESC",
+                (name, version),
+            )
+            older = [row[0] for row in older]
+            if len(older) <= keep:
+                return 0
+            cursor = connect().execute(
+                "DELETE FROM cache WHERE function = ? AND version <= ?",
+                (name, older[keep]),
+            )
+            return cursor.rowcount
+
+        wrapper.cache_path = path
+        wrapper.cache_clear = cache_clear
+        wrapper.invalidate = invalidate
+        wrapper.prune = prune
+        return wrapper
+
+    return decorator
+
+
+#
+# Type checking
+#
+# Set the environment variable DECORATORS_INSTRUMENT=0 to turn off checks
+# that cost time on every call
+INSTRUMENTATION = os.environ.get("DECORATORS_INSTRUMENT", "1") not in {"0", "off"}
+ENFORCE_TYPES = __debug__ and INSTRUMENTATION  # Also turned off by python -O
+ENFORCED = {}  # (module, qualname) -> [function, decorated function]
+_ENFORCED_LOCK = threading.Lock()
+
+
+def _type_check(annotation):
+    """Convert an annotation to a type or tuple usable by isinstance()
+
+    Return None for annotations that can't be checked, like Any, TypeVars, or
+    protocols that aren't runtime checkable. Generic types like list[int] only
+    check the container, not the elements.
+    """
+    if annotation is None or annotation is type(None):
+        return type(None)
+    if annotation is typing.Any or annotation is inspect.Parameter.empty:
+        return None
+
+    origin = typing.get_origin(annotation)
+    if origin is typing.Union or origin is getattr(types, "UnionType", typing.Union):
+        checks = [_type_check(arg) for arg in typing.get_args(annotation)]
+        if None in checks:
+            return None
+        return tuple(
+            check
+            for types_ in checks
+            for check in (types_ if isinstance(types_, tuple) else (types_,))
+        )
+    if origin is typing.Annotated:
+        return _type_check(typing.get_args(annotation)[0])
+    if origin is not None:
+        annotation = origin
+
+    if not isinstance(annotation, type):
+        return None
+    try:
+        isinstance(None, annotation)
+    except TypeError:
+        return None
+    return annotation
+
+
+# Check the types of arguments, defaults, and return values against the
+# annotations of the function. The checks are worked out once when the
+# function is decorated. Set ENFORCE_TYPES = False before decorating to skip
+# them completely, or use set_enforce_types() to change functions later
+def enforce(func):
+    wrapper = _enforce(func) if ENFORCE_TYPES else func
+    key = (func.__module__, func.__qualname__)
+    if key[0] in sys.modules and "<locals>" not in key[1]:
+        with _ENFORCED_LOCK:
+            ENFORCED[key] = [func, wrapper]
+    return wrapper
+
+
+# Add or remove the checks on functions that are already decorated, by
+# rebinding them in their module or class. Functions that already are in the
+# requested state, or that have been replaced since they were decorated, are
+# left alone
+def set_enforce_types(enabled):
+    global ENFORCE_TYPES
+
+    with _ENFORCED_LOCK:
+        ENFORCE_TYPES = bool(enabled)
+        for (module_name, qualname), entry in ENFORCED.items():
+            func, wrapper = entry
+            if (wrapper is not func) == ENFORCE_TYPES:
+                continue
+            *path, name = qualname.split(".")
+            owner = sys.modules.get(module_name)
+            for part in path:
+                owner = getattr(owner, part, None)
+            if owner is not None and vars(owner).get(name) is wrapper:
+                entry[1] = _enforce(func) if enabled else func
+                setattr(owner, name, entry[1])
+
+
+def _enforce(func):
+    signature = inspect.signature(func)
+    try:
+        hints = typing.get_type_hints(func, include_extras=True)
+    except (NameError, TypeError):
+        hints = func.__annotations__
+
+    checks = {}
+    for name in [*signature.parameters, "return"]:
+        if (check := _type_check(hints.get(name, inspect.Parameter.empty))) is not None:
+            checks[name] = check
+
+    # Precompute checks for each kind of parameter, keyed by the names used in
+    # error messages
+    positional, num_positional = [], 0
+    keyword, var_positional, var_keyword = {}, None, None
+    for index, (name, parameter) in enumerate(signature.parameters.items()):
+        check = checks.get(name)
+        if check is not None and parameter.default is None:
+            # Accept None for x: int = None, as if annotated with Optional[int]
+            check = (*(check if isinstance(check, tuple) else (check,)), type(None))
+        if parameter.kind is parameter.VAR_POSITIONAL:
+            var_positional = check and (f"*{name}", check)
+            continue
+        if parameter.kind is parameter.VAR_KEYWORD:
+            var_keyword = check and (f"**{name}", check)
+            continue
+
+        if parameter.kind is not parameter.KEYWORD_ONLY:
+            num_positional = index + 1
+            if check is not None:
+                positional.append((index, name, check))
+        if parameter.kind is not parameter.POSITIONAL_ONLY:
+            keyword[name] = check and (name, check)
+        if check is not None and parameter.default is not parameter.empty:
+            if not isinstance(parameter.default, check):
+                raise TypeError(f"Default for {name!r} should be {hints[name]}")
+    return_check = checks.get("return")
+
+    def check_arguments(args, kwargs):
+        for index, name, check in positional:
+            if index < len(args) and not isinstance(args[index], check):
+                raise TypeError(f"{name!r} should be {hints[name]}")
+        if var_positional is not None:
+            name, check = var_positional
+            for value in args[num_positional:]:
+                if not isinstance(value, check):
+                    raise TypeError(f"{name!r} should be {hints[name[1:]]}")
+        for name, value in kwargs.items():
+            name_check = keyword[name] if name in keyword else var_keyword
+            if name_check is not None and not isinstance(value, name_check[1]):
+                hint = hints[name_check[0].lstrip("*")]
+                raise TypeError(f"{name_check[0]!r} should be {hint}")
+
+    def check_return(value):
+        if return_check is not None and not isinstance(value, return_check):
+            raise TypeError(f"Return value should be {hints['return']}")
+        return value
+
+    if inspect.iscoroutinefunction(func):
+
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            check_arguments(args, kwargs)
+            return check_return(await func(*args, **kwargs))
+
+    else:
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            check_arguments(args, kwargs)
+            return check_return(func(*args, **kwargs))
+
+    return wrapper
@@ -0,0 +1,81 @@
+"""Measure the cost of calling a decorated function
+
+Compare the time and memory used by each decorator in the tutorials with an
+undecorated function:
+
+    $ python benchmarks/decorator_overhead.py
+    $ python benchmarks/decorator_overhead.py --save baseline.json
+    $ python benchmarks/decorator_overhead.py --compare baseline.json
+
+With --compare, the script exits with an error if any benchmark has become
+more than --threshold times slower.
+"""
+import argparse
+import sys
+
+import harness
+
+harness.add_code_paths()
+
+import decorators  # noqa: E402
+
+
+def add(number_1, number_2):
+    return number_1 + number_2
+
+
+def benchmarks_2023():
+    yield "before_and_after", decorators.before_and_after(add)
+    yield "do_twice (two calls)", decorators.do_twice(add)
+    yield "retry", decorators.retry(3)(add)
+    yield "memoize (hit)", decorators.memoize()(add)
+
+
+def benchmarks_2020():
+    try:
+        import pycon_decorators
+    except ImportError as error:
+        print(f"Skipping 2020 decorators ({error})", file=sys.stderr)
+        return
+
+    yield "timer", pycon_decorators.timer(add)
+    yield "timer(metrics=True)", pycon_decorators.timer(metrics=True)(add)
+    yield "trace", pycon_decorators.trace(add)
+    yield "count_calls", pycon_decorators.count_calls(add)
+    yield "CountCalls", pycon_decorators.CountCalls(add)
+    yield "supertrace", pycon_decorators.supertrace(add)
+    try:
+        yield "use_unit", pycon_decorators.use_unit("meters")(add)
+    except ImportError as error:
+        print(f"Skipping use_unit ({error})", file=sys.stderr)
+
+
+def run():
+    results = {"undecorated": (harness.ns_per_call(lambda: add(23, 10)), 0)}
+    with harness.quiet():
+        for name, func in [*benchmarks_2023(), *benchmarks_2020()]:
+            call = lambda: func(23, 10)  # noqa: E731
+            results[name] = (harness.ns_per_call(call), harness.bytes_per_call(call))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--save", metavar="PATH", help="store results as JSON")
+    parser.add_argument("--compare", metavar="PATH", help="compare with stored results")
+    parser.add_argument("--threshold", type=float, default=1.25)
+    args = parser.parse_args()
+
+    results = run()
+    harness.report(results, baseline_ns=results["undecorated"][0])
+    if args.save:
+        harness.save(results, args.save)
+    if args.compare:
+        regressions = harness.compare(results, args.compare, args.threshold)
+        if regressions:
+            print("\nRegressions:", *regressions, sep="\n  ")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Compare naive, memoized, and iterative Fibonacci numbers
+
+The naive version is fibonacci() from task04.py. Stacking @CountCalls on top
+of @Memoize shows how many calls the cache saves.
+
+The memoized version is recursive and would overflow the stack for large
+numbers if called directly. Instead, its cache is filled from the bottom up,
+so that each call only recurses one level before hitting the cache.
+
+    $ python benchmarks/fibonacci.py
+"""
+import sys
+import time
+
+import harness
+
+harness.add_code_paths(harness.ROOT / "2020" / "code", *harness.CODE_PATHS)
+
+import task04  # noqa: E402
+from pycon_decorators import CountCalls, Memoize  # noqa: E402
+
+NAIVE_NUMBERS = [10, 15, 20, 25]
+NUMBERS = [10, 100, 1000, 2000, 5000]
+
+
+@CountCalls
+@Memoize
+def fibonacci_memoized(number):
+    """Calculate Fibonacci numbers like task04.fibonacci(), with a cache"""
+    if number < 2:
+        return 1
+
+    return fibonacci_memoized(number - 1) + fibonacci_memoized(number - 2)
+
+
+def fibonacci_bottom_up(number):
+    """Calculate a memoized Fibonacci number without deep recursion"""
+    for smaller in range(number):
+        fibonacci_memoized(smaller)
+    return fibonacci_memoized(number)
+
+
+def fibonacci_iterative(number):
+    """Calculate Fibonacci numbers with a loop instead of recursion"""
+    previous, current = 1, 1
+    for _ in range(number - 1):
+        previous, current = current, previous + current
+    return current
+
+
+def reset_counts():
+    task04.fibonacci.reset()
+    fibonacci_memoized.reset()
+    fibonacci_memoized.cache.clear()
+    fibonacci_memoized.calls_made.reset()
+    fibonacci_memoized.calls_saved.reset()
+
+
+def measure(func, number):
+    reset_counts()
+    tic = time.perf_counter()
+    value = func(number)
+    return value, time.perf_counter() - tic
+
+
+def main():
+    print(f"{'version':<10} {'n':>6} {'seconds':>10} {'calls':>10} {'saved':>10}")
+    for number in NAIVE_NUMBERS:
+        _, seconds = measure(task04.fibonacci, number)
+        calls = task04.fibonacci.num_calls
+        print(f"{'naive':<10} {number:6} {seconds:10.6f} {calls:10}")
+
+    for number in NUMBERS:
+        expected, seconds = measure(fibonacci_iterative, number)
+        print(f"{'iterative':<10} {number:6} {seconds:10.6f}")
+
+        value, seconds = measure(fibonacci_bottom_up, number)
+        if value != expected:
+            sys.exit(f"Memoized and iterative results differ for {number}")
+        calls = fibonacci_memoized.num_calls
+        saved = fibonacci_memoized.calls_saved.value
+        print(f"{'memoized':<10} {number:6} {seconds:10.6f} {calls:10} {saved:10}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,73 @@
+"""Helpers for timing decorated functions
+
+The code for each tutorial lives in its own folder. add_code_paths() makes
+the decorators importable from the benchmark scripts.
+"""
+import contextlib
+import json
+import os
+import pathlib
+import sys
+import timeit
+import tracemalloc
+
+ROOT = pathlib.Path(__file__).resolve().parent.parent
+CODE_PATHS = [ROOT / "2023" / "code", ROOT / "2020" / "code" / "solutions"]
+
+
+def add_code_paths(*paths):
+    """Add the tutorial code folders to the import path"""
+    for path in paths or CODE_PATHS:
+        if str(path) not in sys.path:
+            sys.path.insert(0, str(path))
+
+
+@contextlib.contextmanager
+def quiet():
+    """Silence decorators that print on every call"""
+    with open(os.devnull, mode="w") as devnull, contextlib.redirect_stdout(devnull):
+        yield
+
+
+def ns_per_call(func, repeat=5):
+    """Best time of one call to func, in nanoseconds"""
+    timer = timeit.Timer(func)
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat=repeat, number=number)) / number * 1e9
+
+
+def bytes_per_call(func, number=100):
+    """Average peak of memory allocated during one call to func, in bytes"""
+    func()  # Warm up caches and lazy initialization
+    tracemalloc.start()
+    try:
+        total = 0
+        for _ in range(number):
+            current, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            func()
+            total += tracemalloc.get_traced_memory()[1] - current
+    finally:
+        tracemalloc.stop()
+    return total / number
+
+
+def report(results, baseline_ns):
+    """Print a table of results, with overhead relative to baseline_ns"""
+    print(f"{'benchmark':<32} {'ns/call':>10} {'overhead':>10} {'bytes/call':>11}")
+    for name, (ns, nbytes) in results.items():
+        print(f"{name:<32} {ns:10.0f} {ns - baseline_ns:10.0f} {nbytes:11.0f}")
+
+
+def save(results, path):
+    pathlib.Path(path).write_text(json.dumps(results, indent=2), encoding="utf-8")
+
+
+def compare(results, path, threshold):
+    """List benchmarks that are more than threshold times slower than before"""
+    previous = json.loads(pathlib.Path(path).read_text(encoding="utf-8"))
+    regressions = []
+    for name, (ns, _) in results.items():
+        if name in previous and ns > previous[name][0] * threshold:
+            regressions.append(f"{name}: {previous[name][0]:.0f} -> {ns:.0f} ns/call")
+    return regressions
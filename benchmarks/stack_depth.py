@@ -0,0 +1,50 @@
+"""Measure the cost of stacked decorators compared to fused decorators
+
+Each stacked decorator adds a wrapper and a function call, while fuse() runs
+the hooks of all decorators inside one wrapper:
+
+    $ python benchmarks/stack_depth.py
+"""
+import itertools
+import sys
+
+import harness
+
+harness.add_code_paths()
+
+
+def add(number_1, number_2):
+    return number_1 + number_2
+
+
+def stacked(decorators, func):
+    for decorator in reversed(decorators):
+        func = decorator(func)
+    return func
+
+
+def main(max_depth=5):
+    try:
+        import pycon_decorators
+    except ImportError as error:
+        sys.exit(f"Can't import the 2020 decorators ({error})")
+
+    # Decorators that don't print, so that printing doesn't hide the overhead
+    quiet_decorators = itertools.cycle(
+        [pycon_decorators.count_calls, pycon_decorators.timer(metrics=True)]
+    )
+    decorators = list(itertools.islice(quiet_decorators, max_depth))
+
+    results = {"undecorated": (harness.ns_per_call(lambda: add(23, 10)), 0)}
+    for depth in range(1, max_depth + 1):
+        for name, func in [
+            (f"stacked, depth {depth}", stacked(decorators[:depth], add)),
+            (f"fused, depth {depth}", pycon_decorators.fuse(*decorators[:depth])(add)),
+        ]:
+            call = lambda: func(23, 10)  # noqa: E731
+            results[name] = (harness.ns_per_call(call), harness.bytes_per_call(call))
+    harness.report(results, baseline_ns=results["undecorated"][0])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""Measure the startup cost of @use_unit
+
+Before, every call to use_unit() created a new pint.UnitRegistry and parsed
+the unit on every call to the decorated function. Now, one registry is shared
+and each unit is parsed once, when the function is decorated.
+
+    $ python benchmarks/use_unit_startup.py
+"""
+import functools
+import subprocess
+import sys
+import time
+
+import harness
+
+harness.add_code_paths(harness.ROOT / "2020" / "code", *harness.CODE_PATHS)
+
+import pycon_decorators  # noqa: E402
+
+try:
+    import pint
+except ImportError:
+    pint = None
+
+NUM_METHODS = 20
+UNITS = ["meters per second", "km per hour", "seconds", "kilograms"]
+
+
+def legacy_use_unit(unit):
+    """The original @use_unit, creating a registry for each decorator"""
+    legacy_use_unit.ureg = pint.UnitRegistry()
+
+    def _use_unit_decorator(func):
+        @functools.wraps(func)
+        def _use_unit(*args, **kwargs):
+            return func(*args, **kwargs) * legacy_use_unit.ureg(unit)
+
+        return _use_unit
+
+    return _use_unit_decorator
+
+
+def speed():
+    return 42 / 3.14
+
+
+def decorate_all(use_unit):
+    """Decorate NUM_METHODS functions and return the seconds used"""
+    tic = time.perf_counter()
+    decorated = [use_unit(UNITS[n % len(UNITS)])(speed) for n in range(NUM_METHODS)]
+    return time.perf_counter() - tic, decorated[0]
+
+
+def import_seconds(module):
+    """Time a fresh import of module in a new interpreter"""
+    code = (
+        "import sys, time; sys.path[:0] = sys.argv[1:]; tic = time.perf_counter();"
+        f"import {module}; print(time.perf_counter() - tic)"
+    )
+    paths = [str(harness.CODE_PATHS[1]), str(harness.ROOT / "2020" / "code")]
+    output = subprocess.run(
+        [sys.executable, "-c", code, *paths], capture_output=True, text=True, check=True
+    )
+    return float(output.stdout)
+
+
+def main():
+    if pint is None:
+        print("Skipping use_unit benchmarks (pint is not installed)", file=sys.stderr)
+        return
+
+    print(f"Import pycon_decorators: {import_seconds('pycon_decorators'):8.4f} s")
+    print(f"Import task05:           {import_seconds('task05'):8.4f} s")
+
+    legacy_seconds, legacy_speed = decorate_all(legacy_use_unit)
+    shared_seconds, shared_speed = decorate_all(pycon_decorators.use_unit)
+    print(f"Decorate {NUM_METHODS} functions, legacy: {legacy_seconds:8.4f} s")
+    print(f"Decorate {NUM_METHODS} functions, shared: {shared_seconds:8.4f} s")
+
+    print(f"Call, legacy: {harness.ns_per_call(legacy_speed):8.0f} ns")
+    print(f"Call, shared: {harness.ns_per_call(shared_speed):8.0f} ns")
+
+
+if __name__ == "__main__":
+    main()